@@ -36,12 +36,13 @@
 # from Adafruit!
 # --------------------------------------------------------------------------
 
+import fcntl
 import os
-import select
 import signal
+import struct
 import time
+from concurrent.futures import ThreadPoolExecutor
 import board
-import busio
 import digitalio
 import adafruit_dotstar as dotstar
 from evdev import InputDevice, ecodes
@@ -59,18 +60,27 @@ pin_slower = board.D24
 vflip      = 'true'      # 'true' if strip input at bottom, else 'false'
 order      = dotstar.BGR # BGR for current DotStars, GBR for pre-2015 strips
 order2     = 'bgr'       # lightpaint lib uses a different syntax for same
+lowlight   = 'false'     # 'true' uses DotStar 5-bit brightness for dim pixels
+# 'lowlight' gives smoother dark tones, but DotStars apply that brightness
+# with a slower PWM that can show as banding in some long exposures.
 spispeed   = 12000000    # SPI clock rate...
 # 12000000 (12 MHz) is the fastest I could reliably operate a 288-pixel
 # strip without glitching. You can try faster, or may need to set it lower,
 # no telling.
+resample   = Image.BILINEAR # Filter for scaling images to strip length.
+# BILINEAR is fast.  Image.LANCZOS is a little sharper but takes several
+# times longer to load large images, which delays the 'ready' indicator.
+max_width  = 4096        # Wider images are scaled down (0 = no limit)
+# A pass can't show more columns than it draws frames, so extremely wide
+# images only cost load time and memory.
 
 # DotStar strip data & clock connect to hardware SPI pins (GPIO 10 & 11).
 strip     = dotstar.DotStar(board.SCK, board.MOSI, num_leds, brightness=1.0,
               auto_write=False, pixel_order=order)
 # The DotStar library is used for status updates (loading progress, etc.),
-# we pull shenanigans here and also access the SPI bus directly for ultra-
+# we pull shenanigans here and also write the SPI device directly for ultra-
 # fast strip updates with data out of the lightpaint library.
-spi       = busio.SPI(board.SCK, MOSI=board.MOSI)
+spi       = os.open('/dev/spidev0.0', os.O_RDWR)
 path      = '/media/usb'         # USB stick mount point
 mousefile = '/dev/input/mouse0'  # Mouse device (as positional encoder)
 eventfile = '/dev/input/event0'  # Mouse events accumulate here
@@ -79,9 +89,23 @@ dev       = None                 # None unless mouse is detected
 gamma          = (2.8, 2.8, 2.8) # Gamma correction curves for R,G,B
 color_balance  = (128, 255, 180) # Max brightness for R,G,B (white balance)
 power_settings = (1450, 1550)    # Battery avg and peak current
+rt_priority    = 50              # SCHED_FIFO priority while painting
+# Real-time priority keeps other processes from preempting the paint loop
+# (seen as wavy columns).  Needs root; 0 disables.
 
 # INITIALIZATION -----------------------------------------------------------
 
+SPI_IOC_WR_MAX_SPEED_HZ = 0x40046B04 # _IOW('k', 4, __u32) from spidev.h
+# spidev rejects writes larger than its 'bufsiz' module parameter, so
+# long strips are sent in chunks (DotStar data may be split anywhere).
+try:
+    with open('/sys/module/spidev/parameters/bufsiz') as f:
+        spi_bufsiz = int(f.read())
+except (OSError, ValueError):
+    spi_bufsiz = 4096 # spidev default
+EV_REL = ecodes.EV_REL # evdev codes as module constants; saves the ecodes
+REL_X  = ecodes.REL_X  # attribute lookup for each mouse event
+
 # Set control pins to inputs and enable pull-up resistors.
 # Buttons should connect between these pins and ground.
 button_go               = digitalio.DigitalInOut(pin_go)
@@ -100,26 +124,40 @@ button_faster           = digitalio.DigitalInOut(pin_faster)
 button_faster.direction = digitalio.Direction.INPUT
 button_faster.pull      = digitalio.Pull.UP
 
-ledBuf = bytearray(4 + (num_leds * 4) + ((num_leds + 15) // 16))
-for i in range(4):
-    ledBuf[i] = 0x00 # 4 header bytes
-for i in range(4 + num_leds * 4, len(ledBuf)):
-    ledBuf[i] = 0xFF # Footer bytes
+# Two LED buffers: one is dithered while the other is sent over SPI.
+# 4 header bytes are zero from bytearray().  Each pixel's 0xFF header
+# byte is set here once; dither() writes only the color bytes (plus
+# per-pixel brightness headers if 'lowlight' is enabled).
+footer = (num_leds + 15) // 16
+ledBuf = (bytearray(4 + num_leds * 4 + footer),
+          bytearray(4 + num_leds * 4 + footer))
+for buf in ledBuf:
+    buf[4:4 + num_leds * 4:4] = b'\xFF' * num_leds # Pixel headers
+    buf[4 + num_leds * 4:]    = b'\xFF' * footer   # Footer bytes
+writer     = ThreadPoolExecutor(max_workers=1) # SPI output thread
+# Start the SPI thread now, so it doesn't inherit the paint loop's CPU
+# pinning (below) and can run on another core.
+writer.submit(time.sleep, 0).result()
 imgNum     = 0    # Index of currently-active image
 duration   = 2.0  # Image paint time, in seconds
 filename   = None # List of image files (nothing loaded yet)
 lightpaint = None # LightPaint object for currently-active image (none yet)
 
-# If a mouse is plugged in, set up epoll for sensing position
-if os.path.exists(mousefile):
-    dev = InputDevice(eventfile)
-    # Register mouse descriptor with epoll
-    epoll = select.epoll()
-    epoll.register(dev.fileno(), select.EPOLLIN)
-    print('Using mouse for positional input')
-
 # FUNCTIONS ----------------------------------------------------------------
 
+# If a mouse is plugged in, open it for sensing position.  Returns the
+# InputDevice, or None if there's no mouse (paint is then time-based).
+def openMouse():
+    if not os.path.exists(mousefile):
+        return None
+    try:
+        dev = InputDevice(eventfile) # Opened non-blocking
+        dev.grab() # Mouse events come only here, not also to the console
+    except OSError:
+        return None
+    print('Using mouse for positional input')
+    return dev
+
 # Signal handler when SIGUSR1 is received (USB flash drive mounted,
 # triggered by usbmount and 99_lightpaint_mount script).
 def sigusr1_handler(signum, frame):
@@ -144,8 +182,7 @@ def scandir():
     for i, f in enumerate(files):
         lower =  i      * num_leds // num_files
         upper = (i + 1) * num_leds // num_files
-        for n in range(lower, upper):
-            strip[n] = (1, 0, 0) # Yellow
+        strip[lower:upper] = [(1, 0, 0)] * (upper - lower) # Yellow
         strip.show()
         if f[0] == '.':
             continue
@@ -166,8 +203,7 @@ def loadImage(index):
     num_images = len(filename)
     lower      =  index      * num_leds // num_images
     upper      = (index + 1) * num_leds // num_images
-    for n in range(lower, upper):
-        strip[n] = (1, 0, 0) # Red = loading
+    strip[lower:upper] = [(1, 0, 0)] * (upper - lower) # Red = loading
     strip.show()
     print("Loading '" + filename[index] + "'...")
     startTime = time.time()
@@ -176,11 +212,21 @@ def loadImage(index):
     print('\t%dx%d pixels' % img.size)
 
     # If necessary, image is vertically scaled to match LED strip.
-    # Width is NOT resized, this is on purpose.  Pixels need not be
-    # square!  This makes for higher-resolution painting on the X axis.
-    if img.size[1] != num_leds:
+    # Width is NOT resized (unless over max_width), this is on purpose.
+    # Pixels need not be square!  This makes for higher-resolution
+    # painting on the X axis.
+    width = img.size[0]
+    if max_width and width > max_width:
+        width = max_width
+    if img.size != (width, num_leds):
         print('\tResizing...',)
-        img = img.resize((img.size[0], num_leds), Image.LANCZOS)
+        # reducing_gap has Pillow do a fast integer box reduction first
+        # so the (slower) resample filter has far fewer input pixels.
+        # Pillow older than 7.0 doesn't have it; resize normally then.
+        try:
+            img = img.resize((width, num_leds), resample, reducing_gap=3.0)
+        except TypeError:
+            img = img.resize((width, num_leds), resample)
         print('now %dx%d pixels' % img.size)
 
     # Convert raw RGB pixel data to a 'bytes' buffer.
@@ -191,27 +237,26 @@ def loadImage(index):
     # Do external C processing on image; this provides 16-bit gamma
     # correction, diffusion dithering and brightness adjustment to
     # match power source capabilities.
-    for n in range(lower, upper):
-        strip[n] = (1, 1, 0) # Yellow
+    strip[lower:upper] = [(1, 1, 0)] * (upper - lower) # Yellow
     strip.show()
     print('Processing...')
     startTime  = time.time()
     # Pixel buffer, image size, gamma, color balance and power settings
-    # are REQUIRED arguments.  One or two additional arguments may
+    # are REQUIRED arguments.  Some additional arguments may
     # optionally be specified:  "order='rgb'" is to maintain compat.
     # (color reordering is done in DotStar lib now)
     # "vflip='true'" indicates that the
     # input end of the strip is at the bottom, rather than top (I
     # prefer having the Pi at the bottom as it provides some weight).
+    # "lowlight='true'" enables per-pixel brightness (see above).
     # Returns a LightPaint object which is used later for dithering
     # and display.
     lightpaint = LightPaint(pixels, img.size, gamma, color_balance,
-      power_settings, order=order2, vflip=vflip)
+      power_settings, order=order2, vflip=vflip, lowlight=lowlight)
     print('\t%f seconds' % (time.time() - startTime))
 
     # Success!
-    for n in range(lower, upper):
-        strip[n] = (0, 1, 0) # Green
+    strip[lower:upper] = [(0, 1, 0)] * (upper - lower) # Green
     strip.show()
     time.sleep(0.25) # Tiny delay so green 'ready' is visible
     print('Ready!')
@@ -220,6 +265,43 @@ def loadImage(index):
     strip.show()
     return lightpaint
 
+# Write LED buffer to SPI device, in chunks of at most spi_bufsiz bytes.
+def spiWrite(buf):
+    view = memoryview(buf)
+    for i in range(0, len(view), spi_bufsiz):
+        os.write(spi, view[i:i + spi_bufsiz])
+
+# Current thread's scheduling policy and parameters.
+def getScheduler():
+    return (os.sched_getscheduler(0), os.sched_getparam(0))
+
+# Switch to real-time scheduling on one CPU core for a paint pass.  The
+# SPI writer thread gets the same priority, since every frame waits on
+# it, but isn't pinned so it can run on another core.  Returns previous
+# settings for endRealtime().  If not permitted, paint carries on at
+# normal priority.
+def startRealtime():
+    if not rt_priority:
+        return None
+    prev  = (getScheduler(), os.sched_getaffinity(0),
+             writer.submit(getScheduler).result())
+    param = os.sched_param(rt_priority)
+    try:
+        os.sched_setaffinity(0, {max(prev[1])}) # Last allowed core
+        os.sched_setscheduler(0, os.SCHED_FIFO, param)
+        writer.submit(os.sched_setscheduler, 0, os.SCHED_FIFO,
+          param).result()
+    except OSError:
+        pass
+    return prev
+
+# Restore scheduling saved by startRealtime().
+def endRealtime(prev):
+    if prev:
+        os.sched_setscheduler(0, *prev[0])
+        os.sched_setaffinity(0, prev[1])
+        writer.submit(os.sched_setscheduler, 0, *prev[2]).result()
+
 def btn():
     if not button_go.value:     return 1
     if not button_faster.value: return 2
@@ -228,6 +310,114 @@ def btn():
     if not button_prev.value:   return 5
     return 0
 
+# Wait while button 'b' is held, up to 'timeout' seconds (None = no
+# limit).  Sleeps between checks rather than spinning a CPU core.
+def waitRelease(b, timeout=None, interval=0.005):
+    startTime = time.monotonic()
+    while btn() == b:
+        if timeout is None:
+            time.sleep(interval)
+        else:
+            remaining = timeout - (time.monotonic() - startTime)
+            if remaining <= 0: break
+            time.sleep(min(remaining, interval))
+
+# Paint one pass of the current image, time- or encoder-based.  Runs as a
+# function so the per-frame names below are fast locals, not globals.
+def paint():
+    global dev
+    if dev is None:
+        # Mouse may have been plugged in, or re-enumerated after a
+        # dropout, since the last pass; this is just a path check.
+        dev = openMouse()
+    prevSched = startRealtime()
+    # SPI speed is shared with the DotStar library, which sets
+    # its own for status updates; set ours for painting.
+    fcntl.ioctl(spi, SPI_IOC_WR_MAX_SPEED_HZ,
+      struct.pack('I', spispeed))
+    # Functions are looked up once here rather than on every
+    # frame; dither() is the compiled C kernel itself.
+    dither  = lightpaint.dither
+    write   = spiWrite
+    submit  = writer.submit
+    pending = None # SPI write in progress, if any
+    back    = 0    # Index of ledBuf being dithered
+    lost    = False # Set if mouse disconnects mid-pass
+
+    if dev is None: # Time-based
+
+        # Monotonic clock is immune to NTP adjustments mid-paint
+        monotonic = time.monotonic
+        startTime = monotonic()
+        while True:
+            elapsed = monotonic() - startTime
+            if elapsed > duration:
+                break
+            # dither() function is passed a destination buffer and
+            # a float from 0.0 to 1.0 indicating which column of
+            # the source image to render.  Interpolation happens.
+            dither(ledBuf[back], elapsed / duration)
+            # Wait for previous frame to finish sending, then
+            # send this one while the next is being dithered.
+            if pending: pending.result()
+            pending = submit(write, ledBuf[back])
+            back   ^= 1
+
+    else: # Encoder-based
+
+        mousepos  = 0
+        # Mouse counts for a full pass; compared as integers
+        threshold = 100 * (speed_pixel + 1)
+        read      = dev.read_one
+        while True:
+            # Drain pending events.  Non-blocking; if the mouse
+            # isn't moving, the same column is re-dithered so
+            # temporal dithering goes on.
+            try:
+                event = read()
+                while event is not None:
+                    if(event.type == EV_REL and
+                       event.code == REL_X):
+                        mousepos += event.value
+                    event = read()
+            except OSError:
+                lost = True
+                break
+
+            pos = mousepos if mousepos >= 0 else -mousepos
+            if pos > threshold: break
+            dither(ledBuf[back], pos / threshold)
+            if pending: pending.result()
+            pending = submit(write, ledBuf[back])
+            back   ^= 1
+
+        if lost:
+            # If this occurs, usually power settings are too
+            # high for battery source.  Voltage sags, Pi loses
+            # track of USB device.  Release the old device and
+            # try reopening it; if it's not back yet, the next
+            # pass tries again (time-based until then).
+            print('LOST MOUSE CONNECTION')
+            try:
+                dev.ungrab()
+            except OSError:
+                pass # Already gone
+            dev.close()
+            dev = openMouse()
+
+    if pending: pending.result() # Last frame out
+    endRealtime(prevSched)
+
+    if lost:
+        # Don't start another pass in the middle of this
+        # exposure; blank strip until button is released.
+        strip.fill(0)
+        strip.show()
+        waitRelease(1)
+    elif btn() != 1: # Button released?
+        strip.fill(0)
+        strip.show()
+
 # MAIN LOOP ----------------------------------------------------------------
 
 # Init some stuff for speed selection...
@@ -239,7 +429,8 @@ duration    = min_time + time_range * speed_pixel / (num_leds - 1)
 prev_btn    = 0
 rep_time    = 0.2
 
-scandir() # USB drive might already be inserted
+dev = openMouse() # Mouse (if present) is used as positional encoder
+scandir()         # USB drive might already be inserted
 signal.signal(signal.SIGUSR1, sigusr1_handler) # USB mount signal
 signal.signal(signal.SIGUSR2, sigusr2_handler) # USB unmount signal
 
@@ -247,52 +438,7 @@ try:
     while True:
         b = btn()
         if b == 1 and lightpaint != None:
-            # Paint!
-            spi.try_lock()
-            spi.configure(baudrate=spispeed)
-
-            if dev is None: # Time-based
-
-                startTime = time.time()
-                while True:
-                    t1      = time.time()
-                    elapsed = t1 - startTime
-                    if elapsed > duration:
-                        break
-                    # dither() function is passed a destination buffer and
-                    # a float from 0.0 to 1.0 indicating which column of
-                    # the source image to render.  Interpolation happens.
-                    lightpaint.dither(ledBuf, elapsed / duration)
-                    spi.write(ledBuf)
-
-            else: # Encoder-based
-
-                mousepos = 0
-                scale    = 0.01 / (speed_pixel + 1)
-                while True:
-                    input = epoll.poll(-1) # Non-blocking
-                    for i in input: # For each pending...
-                        try:
-                            for event in dev.read():
-                                if(event.type == ecodes.EV_REL and
-                                   event.code == ecodes.REL_X):
-                                    mousepos += event.value
-                        except:
-                            # If this occurs, usually power settings
-                            # are too high for battery source.
-                            # Voltage sags, Pi loses track of USB device.
-                            print('LOST MOUSE CONNECTION')
-                            continue
-
-                    pos = abs(mousepos) * scale
-                    if pos > 1.0: break
-                    lightpaint.dither(ledBuf, pos)
-                    spi.write(ledBuf)
-
-            if btn() != 1: # Button released?
-                spi.unlock()
-                strip.fill(0)
-                strip.show()
+            paint()
 
         elif b == 2:
             # Decrease paint duration
@@ -302,9 +448,7 @@ try:
                   speed_pixel / (num_leds - 1))
             strip[speed_pixel] = (0, 0, 128)
             strip.show()
-            startTime = time.time()
-            while (btn() == 2 and ((time.time() - startTime) <
-              rep_time)): continue
+            waitRelease(2, rep_time)
             strip.fill(0)
             strip.show()
         elif b == 3:
@@ -315,9 +459,7 @@ try:
                   speed_pixel / (num_leds - 1))
                 strip[speed_pixel] = (0, 0, 128)
                 strip.show()
-                startTime = time.time()
-                while (btn() == 3 and ((time.time() - startTime) <
-                  rep_time)): continue
+                waitRelease(3, rep_time)
                 strip.fill(0)
                 strip.show()
         elif b == 4 and filename != None:
@@ -325,13 +467,13 @@ try:
             imgNum += 1
             if imgNum >= len(filename): imgNum = 0
             lightpaint = loadImage(imgNum)
-            while btn() == 4: continue
+            waitRelease(4, interval=0.02)
         elif b == 5 and filename != None:
             # Previous image (if USB drive present)
             imgNum -= 1
             if imgNum < 0: imgNum = len(filename) - 1
             lightpaint = loadImage(imgNum)
-            while btn() == 5: continue
+            waitRelease(5, interval=0.02)
         if b > 0 and b == prev_btn:
             # If button held, accelerate speed selection
             rep_time *= 0.92
@@ -342,6 +484,7 @@ try:
 
 except KeyboardInterrupt:
     print('Cleaning up')
+    writer.shutdown()
     strip.fill(0)
     strip.show()
     print('Done!')
@@ -33,7 +33,12 @@ typedef struct {
 	uint8_t  *tables;        // Various dithering lookup tables
 	double    px;            // Last x value passed to dither()
 	Py_buffer pixelBuf;      // Python image pixel buffer
-	uint8_t   vFlip;         // If >0, input at BOTTOM of strip
+	// Per-image constants, computed once here rather than every
+	// dither() call.  vflip is folded into rowStart and rowInc.
+	double    xScale;        // Image width-1, for column interpolation
+	uint32_t  rowStart;      // Offset of first row to output
+	int32_t   rowInc;        // Offset between rows (<0 if input at bottom)
+	uint8_t   lowLight;      // If >0, use per-pixel 5-bit brightness
 } LightPaintObject;
 
 // CONSTRUCTOR: allocate a new LightPaint object for a given PIL Image and
@@ -45,6 +50,8 @@ typedef struct {
 // as a keyword argument, e.g. append "order='gbr'" if using older DotStar
 // pixels (BRG is default).  Optionally pass "vflip='true'" to flip image
 // vertically if input end of strip is at the bottom rather than top.
+// Optionally pass "lowlight='true'" to use each DotStar's 5-bit global
+// brightness field for extra precision in dim pixels (see dither()).
 static PyObject *LightPaint_new(
   PyTypeObject *type, PyObject *arg, PyObject *kw) {
         LightPaintObject *self = NULL;
@@ -57,8 +64,10 @@ static PyObject *LightPaint_new(
 	PyObject         *string,           // 'order' value as Python object
 	                 *tmpbytes;         // For unicode conversion
 	char             *order = NULL,     // 'order' value as C string
-	                 *vf    = NULL;     // 'vflip' value as C string
-        uint8_t           vFlip = 0;        // If set, input at strip bottom
+	                 *vf    = NULL,     // 'vflip' value as C string
+	                 *ll    = NULL;     // 'lowlight' value as C string
+        uint8_t           vFlip = 0,        // If set, input at strip bottom
+	                  lowLight = 0;     // If set, use 5-bit brightness
 
 	// See comments above re: required arguments
 	if(!PyArg_ParseTuple(arg, "s*(II)(ddd)(bbb)(II)",
@@ -101,6 +110,24 @@ static PyObject *LightPaint_new(
 			}
 			Py_DECREF(tmpbytes);
 		}
+
+		// Use keyword 'lowlight' ("lowlight='true'", '1' or 1) to
+		// enable per-pixel brightness; default is 'false'.
+		if((string = PyDict_GetItemString(kw, "lowlight"))) {
+			if(PyLong_Check(string)) {
+				lowLight = (PyObject_IsTrue(string) > 0);
+			} else if((tmpbytes = PyUnicode_AsEncodedString(
+			  string, "UTF-8", "strict"))) {
+				if(ll = PyBytes_AS_STRING(tmpbytes)) {
+					lowLight =
+					  ((!strcasecmp(ll, "true")) ||
+					  !strcmp(ll, "1"));
+				}
+				Py_DECREF(tmpbytes);
+			} else {
+				PyErr_Clear(); // Other types: leave off
+			}
+		}
 	}
 
 	// Allocate LightPaintObject...
@@ -113,26 +140,53 @@ static PyObject *LightPaint_new(
 			self->height   = height;
 			self->px       = 2.0;
 			self->pixelBuf = pixelBuf; // Released in destructor
-			self->vFlip    = vFlip;
+			self->xScale   = (double)(width - 1);
+			self->rowStart = 0;
+			self->rowInc   = (int32_t)width * 3;
+			self->lowLight = lowLight;
+			if(vFlip) { // Input at bottom; output rows bottom-up
+				self->rowStart = width * 3 * (height - 1);
+				self->rowInc   = -self->rowInc;
+			}
 			memcpy(self->offset, offset, sizeof(offset));
 
 			// STEP 1 of 3: estimate average and max power at
 			// given color balance settings.
 
-			uint16_t x, y, c, i, j, n;
+			uint16_t x, y, c, i, n;
 			uint8_t *in, r, g, b;
-			double   colMaxC = 0.0, // Maximum column current
-			         colAvgC = 0.0, // Average column current
-			         colC,          // Current column current
-			         mA[3];
+			uint32_t colC,            // Current column current, uA
+			         colMax = 0,      // Maximum column current, uA
+			         uA0 = (uint32_t)(mA0 * 1000.0 + 0.5),
+			         uAlevel[3][256]; // uA for each R,G,B level
+			uint64_t colSum = 0;      // Sum of column currents, uA
+			double   colMaxC,       // Maximum column current, mA
+			         colAvgC,       // Average column current, mA
+			         mA[3],
+			         level[3][256]; // Gamma curve for R,G,B
 
 			// Milliamp ratings for given R,G,B maximums
 			mA[0] = mAR * (double)max[0] / 255.0;
 			mA[1] = mAG * (double)max[1] / 255.0;
 			mA[2] = mAB * (double)max[2] / 255.0;
 
+			// Gamma depends only on the 8-bit level, not the
+			// pixel, so pow() is done once per level here rather
+			// than three times for every pixel in the image.
+			// The same curve is reused for the dither tables.
+			// Per-level current is kept as integer microamps so
+			// the per-pixel sums below are plain integer adds.
+			for(c=0; c<3; c++) {
+				for(i=0; i<256; i++) {
+					level[c][i]   = pow((double)i / 255.0,
+					  gamma[c]);
+					uAlevel[c][i] = (uint32_t)(level[c][i] *
+					  mA[c] * 1000.0 + 0.5);
+				}
+			}
+
 			for(x=0; x<width; x++) { // For each column...
-				colC = 0.0;      // Clear column sum
+				colC = 0;        // Clear column sum
 				for(y=0; y<height; y++) { // Each row...
 					// Python image order is always
 					// R,G,B; strip color order doesn't
@@ -141,16 +195,15 @@ static PyObject *LightPaint_new(
 					r     = *in++;
 					g     = *in++;
 					b     = *in;
-					// Est. pixel mA, add to column sum
-					colC += mA0 +
-					  pow((double)r/255.0,gamma[0])*mA[0]+
-					  pow((double)g/255.0,gamma[1])*mA[1]+
-					  pow((double)b/255.0,gamma[2])*mA[2];
+					// Est. pixel uA, add to column sum
+					colC += uA0 + uAlevel[0][r] +
+					  uAlevel[1][g] + uAlevel[2][b];
 				}
-				if(colC > colMaxC) colMaxC = colC;
-				colAvgC += colC;
+				if(colC > colMax) colMax = colC;
+				colSum += colC;
 			}
-			colAvgC /= (double)width;
+			colMaxC = (double)colMax / 1000.0;
+			colAvgC = (double)colSum / 1000.0 / (double)width;
 			//printf("Avg current: %f mA\n", colAvgC);
 			//printf("Peak current: %f mA\n", colMaxC);
 
@@ -172,9 +225,8 @@ static PyObject *LightPaint_new(
 			for(c=0; c<3; c++) { // R,G,B
 				for(i=0; i<256; i++) {
 					// Calc 16-bit gamma-corrected level
-					n = (uint16_t)(pow((double)i / 255.0,
-					  gamma[c]) * (double)max[c] * 256.0 +
-					  0.5);
+					n = (uint16_t)(level[c][i] *
+					  (double)max[c] * 256.0 + 0.5);
 					// Store as 8-bit brightness level
 					// and 'dither up' probability.
 					self->tables[       c * 256 + i] =
@@ -183,14 +235,19 @@ static PyObject *LightPaint_new(
 					  n & 0xFF;
 				}
 				// Second pass, calc 'next' level for each
-				// 8-bit brightness (based on lower value)
-				for(i=0; i<256; i++) {
-					n = self->tables[c * 256 + i];
-					for(j=i; (j<256) &&
-					  (self->tables[c * 256 + j] <= n);
-					  j++);
-					self->tables[768 + c * 256 + i] =
-					  self->tables[c * 256 + j];
+				// 8-bit brightness (based on lower value).
+				// Lower values never decrease with i, so a
+				// single walk down from the top finds them.
+				// Top levels have no 'next'; their fraction
+				// is 0, so that entry is never used.
+				n = self->tables[c * 256 + 255];
+				self->tables[768 + c * 256 + 255] = n;
+				for(i=255; i--; ) {
+					if(self->tables[c * 256 + i] <
+					   self->tables[c * 256 + i + 1]) {
+						n = self->tables[c * 256 + i + 1];
+					}
+					self->tables[768 + c * 256 + i] = n;
 				}
 			}
 
@@ -206,15 +263,91 @@ static PyObject *LightPaint_new(
 	return (PyObject *)self;
 }
 
+// Dither a 16-bit level to 8 bits using error accumulator *err.
+static inline uint8_t dither16(uint32_t v, uint8_t *err) {
+	uint16_t e = (v & 0xFF) + *err;
+	v >>= 8;
+	if(e >= 256) { // Error >= 1.0; use brighter color (if there is one)
+		if(v < 255) v++;
+		e -= 256;
+	}
+	*err = e;
+	return v;
+}
+
+// 'lowlight' variant of the dither() pixel loop.  Each pixel's 16-bit
+// gamma-corrected levels are scaled up to fill the 8-bit range and the
+// DotStar's 5-bit brightness header is set to scale them back down, so
+// dim pixels keep several more bits before dithering.  DotStars apply
+// this brightness with a slower PWM than the color channels, which can
+// show as banding in some long exposures; hence this is optional.
+static void ditherLowLight(LightPaintObject *self, uint8_t *ledPtr,
+  uint8_t *leftPtr, uint8_t *rightPtr, int32_t rowInc,
+  uint16_t lWeight, uint16_t rWeight) {
+	// 31/brightness as 8.8 fixed point, indexed by brightness (1-31)
+	static const uint16_t scale[32] = { 0,
+	  7936, 3968, 2645, 1984, 1587, 1322, 1133, 992, 881, 793, 721,
+	  661, 610, 566, 529, 496, 466, 440, 417, 396, 377, 360, 345, 330,
+	  317, 305, 293, 283, 273, 264, 256 };
+	uint32_t  r, g, b, peak, s;
+	uint16_t  y;
+	uint8_t   n, bright,
+	          rOff  = self->offset[0],
+	          gOff  = self->offset[1],
+	          bOff  = self->offset[2],
+	         *rLo   = self->tables, // Same tables as dither()
+	         *gLo   = &rLo[256],
+	         *bLo   = &gLo[256],
+	         *rFrac = &bLo[256 * 4],
+	         *gFrac = &rFrac[256],
+	         *bFrac = &gFrac[256],
+	         *rErr  = &bFrac[256],
+	         *gErr  = &rErr[self->height],
+	         *bErr  = &gErr[self->height];
+
+	for(y = self->height; y--; ) {
+		// Interpolate columns, then 16-bit gamma-corrected R,G,B
+		n = (leftPtr[0] * lWeight + rightPtr[0] * rWeight) >> 8;
+		r = (rLo[n] << 8) | rFrac[n];
+		n = (leftPtr[1] * lWeight + rightPtr[1] * rWeight) >> 8;
+		g = (gLo[n] << 8) | gFrac[n];
+		n = (leftPtr[2] * lWeight + rightPtr[2] * rWeight) >> 8;
+		b = (bLo[n] << 8) | bFrac[n];
+
+		// Smallest brightness (1-31) that can still reach the
+		// brightest channel, then scale all three up to suit.
+		peak = r;
+		if(g > peak) peak = g;
+		if(b > peak) peak = b;
+		bright = ((peak * 31) >> 16) + 1;
+		s      = scale[bright];
+
+		ledPtr[0]    = 0xE0 | bright; // DotStar pixel header
+		ledPtr[rOff] = dither16((r * s) >> 8, rErr++);
+		ledPtr[gOff] = dither16((g * s) >> 8, gErr++);
+		ledPtr[bOff] = dither16((b * s) >> 8, bErr++);
+
+		leftPtr  += rowInc; // Advance 1 row in src image
+		rightPtr += rowInc;
+		ledPtr   += 4;      // Advance 1 pixel in dest buffer
+	}
+}
+
 // Process one column from source image to dest LED buffer.  Interpolates
 // between image columns, reorders R,G,B, applies 16-bit gamma correction
-// and diffusion dithering.
+// and diffusion dithering.  Only the color bytes of each pixel are
+// written; the caller sets the 0xFF DotStar pixel headers once up front
+// (except in 'lowlight' mode, which sets each pixel's brightness header).
 static PyObject *dither(LightPaintObject *self, PyObject *arg) {
 	Py_buffer ledBuf;
 	double    x;
-	uint32_t  lCol, rCol, rowInc;
+	uint32_t  lCol, rCol;
+	int32_t   rowInc;
 	uint16_t  lWeight, rWeight, e, y;
 	uint8_t   n,
+	          rOff  = self->offset[0], // R,G,B offsets within LED,
+	          gOff  = self->offset[1], // copied to locals so they're
+	          bOff  = self->offset[2], // not reloaded after each store
 	         *ledPtr, *leftPtr, *rightPtr,
 	         *rLo   = self->tables, // Gamma lookup tables for R,G,B
 	         *gLo   = &rLo[256],    // First 3 are 8-bit lower brightness
@@ -225,7 +358,9 @@ static PyObject *dither(LightPaintObject *self, PyObject *arg) {
 	         *rFrac = &bHi[256],    // Next 3 are 8-bit gamma fraction
 	         *gFrac = &rFrac[256],
 	         *bFrac = &gFrac[256],
-	         *ePtr  = &bFrac[256];  // Last is dither error accumulator
+	         *rErr  = &bFrac[256],  // Last are dither error accumulators,
+	         *gErr  = &rErr[self->height], // one plane per color
+	         *bErr  = &gErr[self->height];
 
 	if(!PyArg_ParseTuple(arg, "s*d", &ledBuf, &x)) return NULL;
 	if(x < self->px) {
@@ -234,7 +369,7 @@ static PyObject *dither(LightPaintObject *self, PyObject *arg) {
 	}
 	self->px = x;
 
-	x       *= (double)(self->width - 1); // 0.0 to image width-1
+	x       *= self->xScale; // 0.0 to image width-1
 	lCol     = (int)x;
 	rCol     = lCol + 1;
 	if(rCol >= self->width) rCol = self->width - 1;
@@ -242,57 +377,58 @@ static PyObject *dither(LightPaintObject *self, PyObject *arg) {
 	rWeight  = 1 + (int)((x - (double)lCol) * 256.0);
 	lWeight  = 257 - rWeight;
 	ledPtr   = ledBuf.buf + 4;              // -> Output data
-	leftPtr  = &self->pixels[lCol * 3]; // -> Left column input
-	rightPtr = &self->pixels[rCol * 3]; // -> Right column input
-	rowInc   = self->width * 3;
-
-	if(self->vFlip) {
-		leftPtr  += rowInc * (self->height - 1);
-		rightPtr += rowInc * (self->height - 1);
-		rowInc   *= -1;
-	}
-
-	for(y = self->height; y--; ) {
-		ledPtr[0] = 0xFF; // DotStar pixel header
-
+	leftPtr  = &self->pixels[self->rowStart + lCol * 3]; // -> Left col
+	rightPtr = &self->pixels[self->rowStart + rCol * 3]; // -> Right col
+	rowInc   = self->rowInc;
+
+	// Nothing below touches Python objects, so other threads (e.g. one
+	// sending the previous frame out over SPI) may run meanwhile.
+	Py_BEGIN_ALLOW_THREADS
+
+	if(self->lowLight) {
+		ditherLowLight(self, ledPtr, leftPtr, rightPtr, rowInc,
+		  lWeight, rWeight);
+	} else for(y = self->height; y--; ) {
 		// Interpolate left/right column red values
 		n = (leftPtr[0] * lWeight + rightPtr[0] * rWeight) >> 8;
 		// Add dither probability for value to accumulated error
-		if((e = (rFrac[n] + *ePtr)) < 256) { // <1.0 ?
+		if((e = (rFrac[n] + *rErr)) < 256) { // <1.0 ?
 			// Error term below 1.0; use dimmer color
-			ledPtr[self->offset[0]] = rLo[n];
+			ledPtr[rOff] = rLo[n];
 		} else {
 			// Error >= 1.0; use brighter color...
-			ledPtr[self->offset[0]] = rHi[n];
+			ledPtr[rOff] = rHi[n];
 			e -= 256; // ...and reduce error by 1.0
 		}
-		*ePtr++ = e; // Store modified error term back in buffer
+		*rErr++ = e; // Store modified error term back in buffer
 
 		// Green:
 		n = (leftPtr[1] * lWeight + rightPtr[1] * rWeight) >> 8;
-		if((e = (gFrac[n] + *ePtr)) < 256) {
-			ledPtr[self->offset[1]] = gLo[n];
+		if((e = (gFrac[n] + *gErr)) < 256) {
+			ledPtr[gOff] = gLo[n];
 		} else {
-			ledPtr[self->offset[1]] = gHi[n];
+			ledPtr[gOff] = gHi[n];
 			e -= 256;
 		}
-		*ePtr++ = e;
+		*gErr++ = e;
 
 		// Blue:
 		n = (leftPtr[2] * lWeight + rightPtr[2] * rWeight) >> 8;
-		if((e = (bFrac[n] + *ePtr)) < 256) {
-			ledPtr[self->offset[2]] = bLo[n];
+		if((e = (bFrac[n] + *bErr)) < 256) {
+			ledPtr[bOff] = bLo[n];
 		} else {
-			ledPtr[self->offset[2]] = bHi[n];
+			ledPtr[bOff] = bHi[n];
 			e -= 256;
 		}
-		*ePtr++ = e;
+		*bErr++ = e;
 
 		leftPtr  += rowInc; // Advance 1 row in src image
 		rightPtr += rowInc;
 		ledPtr   += 4;      // Advance 1 pixel in dest buffer
 	}
 
+	Py_END_ALLOW_THREADS
+
 	PyBuffer_Release(&ledBuf);
 	Py_INCREF(Py_None);
 	return Py_None;